@@ -49,6 +49,19 @@ def calc_iou(bbox1, bbox2):
     )
 
 
+def calc_iou_batch(bbox, bboxes):
+    """Vectorized `calc_iou` between a box and an array of boxes of shape (n, 4)."""
+    bboxes = np.asarray(bboxes).reshape((-1, 4))
+    x1 = np.maximum(bbox[0], bboxes[:, 0])
+    y1 = np.maximum(bbox[1], bboxes[:, 1])
+    x2 = np.minimum(bbox[2], bboxes[:, 2])
+    y2 = np.minimum(bbox[3], bboxes[:, 3])
+    wh = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+    areas = (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+    return wh / (area + areas - wh)
+
+
 class BaseTracker:
     """Base class for a constant-velocity Kalman filter-based tracker."""
 
@@ -15,28 +15,50 @@ import os
 import pandas as pd
 import pickle
 import re
-import scipy.linalg.interpolative as sli
 import shelve
 import warnings
 from collections import defaultdict
 
 import deeplabcut
 from deeplabcut.utils.auxfun_videos import VideoWriter
-from functools import partial
+from functools import cached_property, partial
 from deeplabcut.pose_estimation_tensorflow.lib.trackingutils import (
     calc_iou,
+    calc_iou_batch,
     TRACK_METHODS,
 )
 from deeplabcut.utils import auxiliaryfunctions, auxfun_multianimal
 from itertools import combinations, cycle
 from networkx.algorithms.flow import preflow_push
+from numba import jit
+from numpy.lib.stride_tricks import sliding_window_view
 from pathlib import Path
-from scipy.linalg import hankel
-from scipy.spatial.distance import directed_hausdorff
 from scipy.stats import mode
 from tqdm import trange
 
 
+@jit(nopython=True, cache=True)
+def _hausdorff_sq(u, v, cmax_sq):
+    """
+    Return the squared directed Hausdorff distance from the 2D points `u`
+    to `v`, or `cmax_sq` if it is larger. Passing the result of the reverse
+    direction as `cmax_sq` thus yields the undirected distance, and allows
+    breaking early as soon as a point cannot increase the running maximum.
+    Points with missing coordinates are ignored.
+    """
+    for i in range(u.shape[0]):
+        cmin = 1e308
+        for j in range(v.shape[0]):
+            d = (u[i, 0] - v[j, 0]) ** 2 + (u[i, 1] - v[j, 1]) ** 2
+            if d < cmin:
+                cmin = d
+                if cmin < cmax_sq:
+                    break
+        if cmax_sq < cmin < 1e308:
+            cmax_sq = cmin
+    return cmax_sq
+
+
 class Tracklet:
     def __init__(self, data, inds):
         """
@@ -65,7 +87,7 @@ class Tracklet:
             idx = np.argsort(inds, kind="mergesort")  # For stable sort with duplicates
             self.inds = self.inds[idx]
             self.data = self.data[idx]
-        self._centroid = None
+        self._reset_cache()
 
     def __len__(self):
         return self.inds.size
@@ -97,7 +119,17 @@ class Tracklet:
 
     def __contains__(self, other_tracklet):
         """Test whether tracklets temporally overlap."""
-        return np.isin(self.inds, other_tracklet.inds, assume_unique=True).any()
+        if self < other_tracklet or self > other_tracklet:
+            return False
+        # Overlapping time spans must share frames if both are gapless
+        if self.is_continuous and other_tracklet.is_continuous:
+            return True
+        # Otherwise, look up the (sorted) frames of the shorter tracklet
+        # among those of the longer one, typically a residual against a track.
+        short, long = sorted((self, other_tracklet), key=len)
+        idx = np.searchsorted(long.inds, short.inds)
+        np.minimum(idx, len(long) - 1, out=idx)
+        return np.any(long.inds[idx] == short.inds)
 
     def __repr__(self):
         return (
@@ -110,23 +142,32 @@ class Tracklet:
         """Return the x and y coordinates."""
         return self.data[..., :2]
 
-    @property
+    @cached_property
     def centroid(self):
         """
-        Return the instantaneous 2D position of the Tracklet centroid.
-        For Tracklets longer than 10 frames, the centroid is automatically
-        smoothed using an exponential moving average.
+        Return the instantaneous 2D position of the Tracklet centroid,
+        i.e., the likelihood-weighted average of its keypoints.
         The result is cached for efficiency.
         """
-        if self._centroid is None:
-            self._update_centroid()
-        return self._centroid
-
-    def _update_centroid(self):
         like = self.data[..., 2:3]
-        self._centroid = np.nansum(self.xy * like, axis=1) / np.nansum(like, axis=1)
+        return np.nansum(self.xy * like, axis=1) / np.nansum(like, axis=1)
+
+    _cached_properties = (
+        "centroid",
+        "likelihood",
+        "_hankelet",
+        "_hankelet_gram",
+        "_singular_values",
+    )
 
-    @property
+    def _reset_cache(self):
+        """Discard quantities derived from the data, to be lazily recomputed."""
+        for name in self._cached_properties:
+            self.__dict__.pop(name, None)
+        self._endpoint_bboxes = {}
+        self._velocities = {}
+
+    @cached_property
     def likelihood(self):
         """Return the average likelihood of all Tracklet detections."""
         return np.nanmean(self.data[..., 2])
@@ -163,12 +204,13 @@ class Tracklet:
 
     def set_data_at(self, ind, data):
         self.data[np.searchsorted(self.inds, ind)] = data
+        self._reset_cache()
 
     def del_data_at(self, ind):
         idx = np.searchsorted(self.inds, ind)
         self.inds = np.delete(self.inds, idx)
         self.data = np.delete(self.data, idx, axis=0)
-        self._update_centroid()
+        self._reset_cache()
 
     def interpolate(self, max_gap=1):
         if max_gap < 1:
@@ -208,7 +250,14 @@ class Tracklet:
         or `tail` of the Tracklet, computed over the last or first
         three frames, respectively. If `norm`, return the absolute
         speed rather than a 2D vector.
+        The result is cached for efficiency.
         """
+        key = where, norm
+        if key not in self._velocities:
+            self._velocities[key] = self._calc_velocity(where, norm)
+        return self._velocities[key]
+
+    def _calc_velocity(self, where, norm):
         if where == "tail":
             vel = (
                 np.diff(self.centroid[:3], axis=0)
@@ -223,7 +272,9 @@ class Tracklet:
             raise ValueError(f"Unknown where={where}")
         if norm:
             return np.sqrt(np.sum(vel ** 2, axis=1)).mean()
-        return vel.mean(axis=0)
+        vel = vel.mean(axis=0)
+        vel.flags.writeable = False
+        return vel
 
     @property
     def maximal_velocity(self):
@@ -263,10 +314,10 @@ class Tracklet:
         of one to the tail/head of the other.
         """
         if self in other_tracklet:
-            dist = (
-                self.centroid[np.isin(self.inds, other_tracklet.inds)]
-                - other_tracklet.centroid[np.isin(other_tracklet.inds, self.inds)]
+            _, inds1, inds2 = np.intersect1d(
+                self.inds, other_tracklet.inds, assume_unique=True, return_indices=True
             )
+            dist = self.centroid[inds1] - other_tracklet.centroid[inds2]
             return np.sqrt(np.sum(dist ** 2, axis=1)).mean()
         elif self < other_tracklet:
             return np.sqrt(
@@ -287,20 +338,15 @@ class Tracklet:
         time_gap = self.time_gap_to(other_tracklet)
         if time_gap > 0:
             if self < other_tracklet:
-                d1 = self.centroid[-1] + time_gap * self.calc_velocity(norm=False)
-                d2 = other_tracklet.centroid[
-                    0
-                ] - time_gap * other_tracklet.calc_velocity("tail", False)
-                delta1 = other_tracklet.centroid[0] - d1
-                delta2 = self.centroid[-1] - d2
+                first, second = self, other_tracklet
             else:
-                d1 = other_tracklet.centroid[
-                    -1
-                ] + time_gap * other_tracklet.calc_velocity(norm=False)
-                d2 = self.centroid[0] - time_gap * self.calc_velocity("tail", False)
-                delta1 = self.centroid[0] - d1
-                delta2 = other_tracklet.centroid[-1] - d2
-            return (np.sqrt(np.sum(delta1 ** 2)) + np.sqrt(np.sum(delta2 ** 2))) / 2
+                first, second = other_tracklet, self
+            head = first.centroid[-1]
+            tail = second.centroid[0]
+            # Distances between each endpoint and the one extrapolated from the other
+            delta1 = tail - (head + time_gap * first.calc_velocity("head", False))
+            delta2 = head - (tail - time_gap * second.calc_velocity("tail", False))
+            return (np.hypot(*delta1) + np.hypot(*delta2)) / 2
         return 0
 
     def time_gap_to(self, other_tracklet):
@@ -339,23 +385,33 @@ class Tracklet:
 
     @staticmethod
     def undirected_hausdorff(u, v):
-        return max(directed_hausdorff(u, v)[0], directed_hausdorff(v, u)[0])
+        # Seeding the kernel with a cheap lower bound (e.g., from the bounding
+        # boxes) was found to cost more than it saves on keypoint-sized sets.
+        return np.sqrt(_hausdorff_sq(v, u, _hausdorff_sq(u, v, 0.0)))
 
     def calc_bbox(self, ind):
+        # Boxes at either end are cached, as they are queried
+        # every time this tracklet is compared to another one.
+        is_endpoint = ind in (0, -1)
+        if is_endpoint and ind in self._endpoint_bboxes:
+            return self._endpoint_bboxes[ind]
         xy = self.xy[ind]
         bbox = np.empty(4)
         bbox[:2] = np.nanmin(xy, axis=0)
         bbox[2:] = np.nanmax(xy, axis=0)
+        if is_endpoint:
+            bbox.flags.writeable = False
+            self._endpoint_bboxes[ind] = bbox
         return bbox
 
     @staticmethod
     def hankelize(xy):
         ncols = int(np.ceil(len(xy) * 2 / 3))
         nrows = len(xy) - ncols + 1
-        mat = np.empty((2 * nrows, ncols))
-        mat[::2] = hankel(xy[:nrows, 0], xy[-ncols:, 0])
-        mat[1::2] = hankel(xy[:nrows, 1], xy[-ncols:, 1])
-        return mat
+        # Windows are (nrows, 2, ncols) views onto the data, such that
+        # reshaping interleaves the x and y Hankel rows in a single copy.
+        windows = sliding_window_view(xy, ncols, axis=0)
+        return windows.reshape((2 * nrows, ncols))
 
     def to_hankelet(self):
         # See Li et al., 2012. Cross-view Activity Recognition using Hankelets.
@@ -364,7 +420,21 @@ class Tracklet:
         # vel = np.diff(self.centroid, axis=0)
         # vel /= np.linalg.norm(vel, axis=1, keepdims=True)
         # return self.hankelize(vel)
-        return self.hankelize(self.centroid)
+        return self._hankelet
+
+    @cached_property
+    def _hankelet(self):
+        # The matrix is cached (and made read-only) as it is repeatedly
+        # needed when comparing a tracklet against all others.
+        hk = self.hankelize(self.centroid)
+        hk.flags.writeable = False
+        return hk
+
+    @cached_property
+    def _hankelet_gram(self):
+        """Return the Gram matrix of the normalized Hankelet."""
+        hk = self._hankelet
+        return (hk @ hk.T) / np.sum(hk ** 2)
 
     def dynamic_dissimilarity_with(self, other_tracklet):
         """
@@ -375,13 +445,9 @@ class Tracklet:
         See Li et al., 2012.
             Cross-view Activity Recognition using Hankelets.
         """
-        hk1 = self.to_hankelet()
-        hk1 /= np.linalg.norm(hk1)
-        hk2 = other_tracklet.to_hankelet()
-        hk2 /= np.linalg.norm(hk2)
-        min_shape = min(hk1.shape + hk2.shape)
-        temp1 = (hk1 @ hk1.T)[:min_shape, :min_shape]
-        temp2 = (hk2 @ hk2.T)[:min_shape, :min_shape]
+        min_shape = min(self.to_hankelet().shape + other_tracklet.to_hankelet().shape)
+        temp1 = self._hankelet_gram[:min_shape, :min_shape]
+        temp2 = other_tracklet._hankelet_gram[:min_shape, :min_shape]
         return 2 - np.linalg.norm(temp1 + temp2)
 
     def dynamic_similarity_with(self, other_tracklet, tol=0.01):
@@ -411,16 +477,21 @@ class Tracklet:
         See Gavish & Donoho, 2013.
             The optimal hard threshold for singular values is 4/sqrt(3)
         """
-        mat = self.to_hankelet()
         # nrows, ncols = mat.shape
         # beta = nrows / ncols
         # omega = 0.56 * beta ** 3 - 0.95 * beta ** 2 + 1.82 * beta + 1.43
-        _, s, _ = sli.svd(mat, min(10, min(mat.shape)))
+        s = self._singular_values
         # return np.argmin(s > omega * np.median(s))
         eigen = s ** 2
         diff = np.abs(np.diff(eigen / eigen[0]))
         return np.argmin(diff > tol)
 
+    @cached_property
+    def _singular_values(self):
+        # The matrices are small enough for a full LAPACK decomposition
+        # to be cheaper than a randomized, truncated one.
+        return np.linalg.svd(self._hankelet, compute_uv=False)[:10]
+
     def plot(self, centroid_only=True, color=None, ax=None, interactive=False):
         if ax is None:
             fig, ax = plt.subplots()
@@ -436,6 +507,8 @@ class Tracklet:
 
 
 class TrackletStitcher:
+    _frame_ind_pattern = re.compile(r"\d+")
+
     def __init__(
         self,
         tracklets,
@@ -543,12 +616,16 @@ class TrackletStitcher:
         header = dict_of_dict.pop("header", None)
         single = None
         for k, dict_ in dict_of_dict.items():
-            try:
-                inds, data = zip(*[(cls.get_frame_ind(k), v) for k, v in dict_.items()])
-            except ValueError:
+            if not dict_:
                 continue
-            inds = np.asarray(inds)
-            data = np.asarray(data)
+            # Fill arrays in place rather than going through lists of frames
+            nrows = len(dict_)
+            shape = np.shape(next(iter(dict_.values())))
+            inds = np.empty(nrows, dtype=int)
+            data = np.empty((nrows, *shape))
+            for row, (key, val) in enumerate(dict_.items()):
+                inds[row] = cls.get_frame_ind(key)
+                data[row] = val
             try:
                 nrows, ncols = data.shape
                 data = data.reshape((nrows, ncols // 3, 3))
@@ -558,7 +635,7 @@ class TrackletStitcher:
             if k == "single":
                 single = tracklet
             else:
-                tracklets.append(Tracklet(data, inds))
+                tracklets.append(tracklet)
         class_ = cls(
             tracklets, n_tracks, min_length, split_tracklets, prestitch_residuals
         )
@@ -566,10 +643,10 @@ class TrackletStitcher:
         class_.single = single
         return class_
 
-    @staticmethod
-    def get_frame_ind(s):
+    @classmethod
+    def get_frame_ind(cls, s):
         if isinstance(s, str):
-            return int(re.findall(r"\d+", s)[0])
+            return int(cls._frame_ind_pattern.search(s).group())
         return s
 
     @staticmethod
@@ -590,20 +667,22 @@ class TrackletStitcher:
     def n_frames(self):
         return self._last_frame - self._first_frame + 1
 
-    # TODO Avoid looping over all pairs of tracklets
     @staticmethod
     def compute_max_gap(tracklets):
-        gap = defaultdict(list)
-        for tracklet1, tracklet2 in combinations(tracklets, 2):
-            gap[tracklet1].append(tracklet1.time_gap_to(tracklet2))
-        max_gap = 0
-        for vals in gap.values():
-            for val in sorted(vals):
-                if val > 0:
-                    if val > max_gap:
-                        max_gap = val
-                    break
-        return max_gap
+        """
+        Return the largest time gap separating a tracklet
+        from the first one starting after it ends.
+        """
+        n_tracklets = len(tracklets)
+        starts = np.fromiter((t.start for t in tracklets), int, n_tracklets)
+        ends = np.fromiter((t.end for t in tracklets), int, n_tracklets)
+        starts.sort()
+        # Index of the earliest tracklet starting strictly after each one ends
+        next_ = np.searchsorted(starts, ends, side="right")
+        valid = next_ < n_tracklets
+        if not valid.any():
+            return 0
+        return int(np.max(starts[next_[valid]] - ends[valid]))
 
     def mine(self, n_samples):
         p = np.asarray([t.likelihood for t in self])
@@ -646,8 +725,9 @@ class TrackletStitcher:
         self.G = nx.DiGraph()
         self.G.add_node("source", demand=-self.n_tracks)
         self.G.add_node("sink", demand=self.n_tracks)
+        nodes_set = set(nodes)
         nodes_in, nodes_out = zip(
-            *[v.values() for k, v in self._mapping.items() if k in nodes]
+            *[v.values() for k, v in self._mapping.items() if k in nodes_set]
         )
         self.G.add_nodes_from(nodes_in, demand=1)
         self.G.add_nodes_from(nodes_out, demand=-1)
@@ -656,24 +736,33 @@ class TrackletStitcher:
         self.G.add_edges_from(zip(nodes_out, ["sink"] * n_nodes), capacity=1)
         if weight_func is None:
             weight_func = self.calculate_edge_weight
+        # As nodes are sorted by start, the candidate successors of a tracklet
+        # form a contiguous block: those starting within (end, end + max_gap].
+        starts = np.array([node.start for node in nodes])
+        ends = np.array([node.end for node in nodes])
+        first_succ = np.searchsorted(starts, ends, side="right")
+        last_succ = np.searchsorted(starts, ends + max_gap, side="right")
+        # The default weight, i.e., the distance between the head of a tracklet
+        # and the tail of its successors, is evaluated at once for all of them.
+        batched = weight_func is TrackletStitcher.calculate_edge_weight
+        if batched:
+            heads = np.array([node.centroid[-1] for node in nodes])
+            tails = np.array([node.centroid[0] for node in nodes])
+        edges = []
         for i in trange(n_nodes):
             node_i = nodes[i]
-            end = node_i.end
-            for j in range(i + 1, n_nodes):
-                node_j = nodes[j]
-                start = node_j.start
-                gap = start - end
-                if gap > max_gap:
-                    break
-                elif gap > 0:
-                    # The algorithm works better with integer weights
-                    w = int(100 * weight_func(node_i, node_j))
-                    self.G.add_edge(
-                        self._mapping[node_i]["out"],
-                        self._mapping[node_j]["in"],
-                        weight=w,
-                        capacity=1,
-                    )
+            node_out = self._mapping[node_i]["out"]
+            succ = range(first_succ[i], last_succ[i])
+            if batched:
+                diff = heads[i] - tails[first_succ[i] : last_succ[i]]
+                weights = np.sqrt(np.sum(diff ** 2, axis=1))
+            else:
+                weights = [weight_func(node_i, nodes[j]) for j in succ]
+            for j, weight in zip(succ, weights):
+                # The algorithm works better with integer weights
+                w = int(100 * weight)
+                edges.append((node_out, self._mapping[nodes[j]]["in"], w))
+        self.G.add_weighted_edges_from(edges, capacity=1)
 
     def _update_edge_weights(self, weight_func):
         if self.G is None:
@@ -689,7 +778,7 @@ class TrackletStitcher:
             raise ValueError("Inexistent graph. Call `build_graph` first")
 
         try:
-            _, self.flow = nx.capacity_scaling(self.G)
+            _, self.flow = nx.network_simplex(self.G)
             self.paths = self.reconstruct_paths()
         except nx.exception.NetworkXUnfeasible:
             warnings.warn("No optimal solution found. Employing black magic...")
@@ -761,7 +850,7 @@ class TrackletStitcher:
                     self.build_graph(list(remaining_nodes), max_gap=np.inf)
                     self.G.nodes["source"]["demand"] = -incomplete_tracks
                     self.G.nodes["sink"]["demand"] = incomplete_tracks
-                    _, self.flow = nx.capacity_scaling(self.G)
+                    _, self.flow = nx.network_simplex(self.G)
                     paths += self.reconstruct_paths()
             self.paths = paths
             if len(self.paths) != self.n_tracks:
@@ -836,18 +925,21 @@ class TrackletStitcher:
     def _prestitch_residuals(self, max_gap=5):
         G = nx.DiGraph()
         residuals = sorted(self.residuals, key=lambda x: x.start)
+        # Link residuals to those starting less than `max_gap` frames after
+        # their end, weighing edges by the overlap of the boxes at the junction.
+        starts = np.array([res.start for res in residuals])
+        ends = np.array([res.end for res in residuals])
+        first_succ = np.searchsorted(starts, ends, side="right")
+        last_succ = np.searchsorted(starts, ends + max_gap - 1, side="right")
+        heads = np.array([res.calc_bbox(-1) for res in residuals])
+        tails = np.array([res.calc_bbox(0) for res in residuals])
         for i in range(len(residuals)):
-            e = residuals[i].end
-            for j in range(i + 1, len(residuals)):
-                s = residuals[j].start
-                gap = s - e
-                if gap < 1:
-                    continue
-                if gap < max_gap:
-                    w = 1 - residuals[i].box_overlap_with(residuals[j])
-                    G.add_edge(i, j, weight=w)
-                else:
-                    break
+            succ = range(first_succ[i], last_succ[i])
+            if not succ:
+                continue
+            overlaps = calc_iou_batch(heads[i], tails[first_succ[i] : last_succ[i]])
+            for j, overlap in zip(succ, overlaps):
+                G.add_edge(i, j, weight=1 - overlap)
         mini_tracks = []
         to_remove = []
         for comp in nx.connected_components(G.to_undirected()):
@@ -866,21 +958,16 @@ class TrackletStitcher:
         # Refresh temporal bounds
         self._first_frame = min(self.tracks, key=lambda t: t.start).start
         self._last_frame = max(self.tracks, key=lambda t: t.end).end
-        data = []
+        # Fill a single array in place rather than stacking per-track copies.
+        # If there isn't a track for each animal, the extra columns remain NaNs.
+        n_cols = self.tracks[0].data.shape[1] * 3
+        n_slots = max(self.n_tracks, len(self.tracks))
+        data = np.full((self.n_frames, n_slots * n_cols), np.nan)
         # Guarantee track data are sorted in the order defined in the config
-        for track in sorted(self.tracks, key=lambda t: t.identity):
-            flat_data = track.flat_data
-            temp = np.full((self.n_frames, flat_data.shape[1]), np.nan)
-            temp[track.inds - self._first_frame] = flat_data
-            data.append(temp)
-
-        # If there isn't a track for each animal, fill in the dataframe with NaNs
-        missing_tracks = self.n_tracks - len(self.tracks)
-        if missing_tracks > 0:
-            track_shape = self.tracks[0].flat_data.shape[1]
-            data += missing_tracks * [np.full((self.n_frames, track_shape), np.nan)]
-
-        return np.hstack(data)
+        for n, track in enumerate(sorted(self.tracks, key=lambda t: t.identity)):
+            cols = slice(n * n_cols, (n + 1) * n_cols)
+            data[track.inds - self._first_frame, cols] = track.flat_data
+        return data
 
     def format_df(self, animal_names=None):
         data = self.concatenate_data()
@@ -904,7 +991,8 @@ class TrackletStitcher:
         )
         inds = range(self._first_frame, self._last_frame + 1)
         df = pd.DataFrame(data, columns=columns, index=inds)
-        df = df.reindex(range(self._last_frame + 1))
+        if self._first_frame > 0:
+            df = df.reindex(range(self._last_frame + 1))
         if self.single is not None:
             columns = pd.MultiIndex.from_product(
                 [scorer, ["single"], bpts[-n_unique_bpts:], coords],
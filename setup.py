@@ -33,7 +33,7 @@ setuptools.setup(
         "numba>=0.54",
         "matplotlib>=3.3,!=3.7.0,!=3.7.1",
         "networkx>=2.6",
-        "numpy>=1.18.5",
+        "numpy>=1.20",
         "pandas>=1.0.1,!=1.5.0",
         "scikit-image>=0.17",
         "scikit-learn>=1.0",
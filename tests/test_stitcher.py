@@ -11,6 +11,7 @@
 import numpy as np
 import pandas as pd
 import pytest
+from scipy.spatial.distance import directed_hausdorff
 from deeplabcut.refine_training_dataset.stitch import Tracklet, TrackletStitcher
 
 
@@ -98,6 +99,16 @@ def test_tracklet_data_access(tracklet):
     assert TRACKLET_START + 1 not in tracklet.inds
 
 
+@pytest.mark.parametrize("tracklet", make_fake_tracklets())
+def test_tracklet_cache_reset(tracklet):
+    hankelet = tracklet.to_hankelet()
+    assert tracklet.to_hankelet() is hankelet
+    assert not hankelet.flags.writeable
+    tracklet.set_data_at(TRACKLET_START, tracklet.data[0] * 2)
+    assert tracklet.to_hankelet() is not hankelet
+    np.testing.assert_equal(tracklet.centroid[0], tracklet.centroid[1] * 2)
+
+
 @pytest.mark.parametrize(
     "tracklet, where, norm",
     list(zip(make_fake_tracklets(), ("head", "tail"), (False, True))),
@@ -123,6 +134,17 @@ def test_tracklet_affinities(tracklet):
     _ = tracklet.distance_to(other_tracklet)
 
 
+def test_undirected_hausdorff():
+    u = np.random.rand(10, 2) * 100
+    v = np.random.rand(7, 2) * 100
+    expected = max(directed_hausdorff(u, v)[0], directed_hausdorff(v, u)[0])
+    np.testing.assert_allclose(Tracklet.undirected_hausdorff(u, v), expected)
+    # Missing coordinates are ignored
+    u_nan = np.vstack((u, np.full((3, 2), np.nan)))
+    np.testing.assert_allclose(Tracklet.undirected_hausdorff(u_nan, v), expected)
+    np.testing.assert_allclose(Tracklet.undirected_hausdorff(v, u_nan), expected)
+
+
 @pytest.mark.parametrize("tracklet", make_fake_tracklets())
 def test_stitcher_wrong_inputs(tracklet):
     with pytest.raises(IOError):
@@ -167,3 +167,12 @@ def test_calc_bboxes_from_keypoints():
     offset = 50
     bboxes = trackingutils.calc_bboxes_from_keypoints(xyp, offset=offset)
     np.testing.assert_equal(bboxes, [[offset, 0, width + offset, height, 0.5]])
+
+
+def test_calc_iou_batch():
+    xy = np.random.rand(10, 2, 2) * 10
+    bboxes = np.concatenate((xy.min(axis=1), xy.max(axis=1)), axis=1)
+    expected = [trackingutils.calc_iou(bboxes[0], bbox) for bbox in bboxes]
+    np.testing.assert_allclose(
+        trackingutils.calc_iou_batch(bboxes[0], bboxes), expected
+    )